@@ -4,13 +4,12 @@ import json
 import logging
 import os
 import re
+import shutil
 import sys
 from datetime import datetime, timedelta
 from pathlib import Path
 
-import urllib3
-from bs4 import BeautifulSoup
-from mako.template import Template
+from suchagent import DedupIndex, Fields, HttpArchive, Scheduler, SearchIndex
 
 template = """
 <html>
@@ -90,24 +89,35 @@ csv = """\\
 id\tTitel\tZimmer\tFlaeche\tGesamtmiete\tStrasse\tPLZ\tStadtteil\tOrt\tURL\terstellt\tzuletzt gesehen\\
 % for o in objects:
 <%
-zimmer =  list(
-    filter(lambda p: p["key"] == "Zimmer", o["details"]["properties"]))[0]["value"]
-flaeche = list(filter(
-    lambda p: p["key"] == "Wohnfl\u00e4che ca.", o["details"]["properties"]))[0]["value"]
-miete = list(filter(lambda p: p["key"] == "Gesamtmiete",
-             o["details"]["properties"]))[0]["value"]
+fields = o["details"].get("fields") or normalise(o["details"]["properties"])
 %>
-${o["id"]}\t${o["title"]}\t${zimmer}\t${flaeche}\t${miete}\t${o["details"]["address"]["street"]}\t${o["details"]["address"]["zipcode"]}\t${o["details"]["address"]["district"]}\t${o["details"]["address"]["city"]}\t${o["href"]}\t${o["first_seen"]}\t${o["last_seen"]}\\
+${o["id"]}\t${o["title"]}\t${fields["rooms"]}\t${fields["area_m2"]}\t${fields["rent_total"]}\t${o["details"]["address"]["street"]}\t${o["details"]["address"]["zipcode"]}\t${o["details"]["address"]["district"]}\t${o["details"]["address"]["city"]}\t${o["href"]}\t${o["first_seen"]}\t${o["last_seen"]}\\
 % endfor
 """
 
 
-class Bvr:
+class Bvr(Fields):
 
     YES = "Ja"
     NO = "Nein"
 
-    http = None
+    CONVERTABLE_PROPS = set(["Etage", "Etagen im Haus", "Wohnfl\u00e4che\u00a0ca.", "Zimmer", "Schlafzimmer", "Badezimmer",
+                             "Baujahr", "Kaution", "Kaltmiete", "Nebenkosten", "Endenergie­verbrauch"])
+
+    # provider specific property keys to canonical typed fields
+    FIELDS = {
+        "Zimmer": "rooms",
+        "Wohnfl\u00e4che ca.": "area_m2",
+        "Kaltmiete": "rent_cold",
+        "Warmmiete": "rent_total",
+        "Etage": "floor",
+        "Baujahr": "year_built"
+    }
+
+    match_number = re.compile(r"([0-9\.,]+).*")
+
+    _http = None
+    politeness = None
     match_obj_id = None
     base_url = None
     url = None
@@ -115,10 +125,12 @@ class Bvr:
     storage_path = None
     storage_changed = False
     filter = None
+    workers = 1
+    dedup = None
+    search_index = None
 
-    def __init__(self, settings):
+    def __init__(self, settings, transient=False):
 
-        self.http = urllib3.PoolManager()
         self.match_obj_id = re.compile("^.*-in-wilhelmshaven-mieten-(\d+-?\w*)/$")
 
         # apply settings
@@ -130,11 +142,37 @@ class Bvr:
             self.storage_path = self.storage_path.replace(
                 "~", str(Path.home()))
 
+        self.politeness = settings.get("politeness", {})
         self.filter = settings["filter"]
 
+        if settings.get("dedup"):
+            self.dedup = DedupIndex(
+                settings["dedup"].replace("~", str(Path.home())))
+
         # load storage
         self.load_storage()
 
+        if settings.get("search_index"):
+            self.search_index = SearchIndex(
+                settings["search_index"].replace("~", str(Path.home())), readonly=transient)
+            if len(self.search_index) == 0:
+                self.search_index.add(self.storage.values())
+
+    @property
+    def http(self):
+
+        if self._http is None:
+            import urllib3
+
+            self._http = Scheduler(urllib3.PoolManager(), **self.politeness)
+
+        return self._http
+
+    @http.setter
+    def http(self, http):
+
+        self._http = http
+
     def load_storage(self):
 
         try:
@@ -156,6 +194,9 @@ class Bvr:
             f.write(json.dumps(self.storage, indent=2))
             f.close()
             self.storage_changed = False
+
+            if self.dedup:
+                self.dedup.store()
         except FileNotFoundError:
             self.storage = {}
 
@@ -168,6 +209,8 @@ class Bvr:
             data = request.data.decode('utf-8')
         except:
             data = request.data.decode('latin-1')
+        from bs4 import BeautifulSoup
+
         soup = BeautifulSoup(data, "html.parser")
 
         for div in soup.find_all("div", attrs={"class": "property"}):
@@ -200,7 +243,27 @@ class Bvr:
         def _now():
             return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
 
+        def _store(o, details, duplicate=None):
+            o["details"] = details
+            o["first_seen"] = _now()
+            o["last_seen"] = o["first_seen"]
+
+            if self.dedup:
+                duplicate = self.dedup.link(o) or duplicate
+
+            if self.search_index is not None:
+                self.search_index.add([o])
+
+            if duplicate:
+                o["duplicate_of"] = duplicate
+            else:
+                current_objects.append(o)
+
+            self.storage[o["id"]] = o
+
         current_objects = []
+        new_objects = []
+        new_ids = set()
 
         for o in objects:
 
@@ -211,20 +274,54 @@ class Bvr:
 
                 self.storage[o["id"]]["last_seen"] = _now()
 
-            else:
-                details = self.parse_details(o["href"])
-                o["details"] = details
-                o["first_seen"] = _now()
-                o["last_seen"] = o["first_seen"]
-                self.storage[o["id"]] = o
-                current_objects.append(o)
+            elif o["id"] not in new_ids:
+                new_objects.append(o)
+                new_ids.add(o["id"])
 
             self.storage_changed = True
 
+        # fetch details of likely matches first
+        bounds = self.filter_bounds(self.filter)
+        new_objects.sort(key=lambda o: self.match_likelihood(
+            o, bounds), reverse=True)
+
+        if self.workers <= 1:
+
+            for o in new_objects:
+                _store(o, self.parse_details(o["href"]))
+
+        elif len(new_objects) > 0:
+
+            from concurrent.futures import ProcessPoolExecutor
+
+            # fetch details here, parse them in worker processes
+            with ProcessPoolExecutor(max_workers=self.workers) as executor:
+
+                futures = []
+                for o in new_objects:
+                    request = self.http.request("GET", o["href"])
+                    futures.append(executor.submit(
+                        Bvr.parse_details_html, self.base_url, request.data))
+
+                for o, future in zip(new_objects, futures):
+                    _store(o, future.result())
+
+        # report in listing order
+        order = {}
+        for i, o in enumerate(objects):
+            order.setdefault(o["id"], i)
+        current_objects.sort(key=lambda o: order[o["id"]])
+
         return current_objects
 
     def parse_details(self, url):
 
+        request = self.http.request("GET", url)
+        return Bvr.parse_details_html(self.base_url, request.data)
+
+    @classmethod
+    def parse_details_html(cls, base_url, data):
+
         def _parse_address(h2):
 
             match = re.match(r"^([^,]+), ([0-9]+) ([^,]+)(, )?(.*)$", h2)
@@ -264,15 +361,12 @@ class Bvr:
 
         def _convert_property(key, value):
 
-            _convertable_props = ["Etage", "Etagen im Haus", "Wohnfl\u00e4che\u00a0ca.", "Zimmer", "Schlafzimmer",
-                                  "Badezimmer", "Baujahr", "Kaution", "Kaltmiete", "Nebenkosten", "Endenergie­verbrauch"]
-
             def _converter(s):
                 s = s.replace(" 1/2", ",5")
-                match = re.match(r"([0-9\.,]+).*", s)
+                match = cls.match_number.match(s)
                 return float(match.group(1).replace(".", "").replace(",", ".")) if match else 0
 
-            if key in _convertable_props:
+            if key in cls.CONVERTABLE_PROPS:
                 return _converter(value)
             else:
                 return value
@@ -288,8 +382,10 @@ class Bvr:
             "energy": []
         }
 
-        request = self.http.request("GET", url)
-        data = request.data.decode('utf-8')
+        data = data.decode('utf-8')
+
+        from bs4 import BeautifulSoup
+
         soup = BeautifulSoup(data, 'html.parser')
 
         # image gallery
@@ -326,6 +422,8 @@ class Bvr:
             for _feature in _features.find_all("li"):
                 details["features"].append(_feature.text.strip())
 
+        details["fields"] = cls.normalise_properties(details["properties"])
+
         return details
 
     def apply_filter(self, objects, filter=filter):
@@ -333,7 +431,13 @@ class Bvr:
         if filter is None:
             return objects
 
-        filtered_objects = []
+        return list(self.iter_filter(objects, filter))
+
+    def iter_filter(self, objects, filter=filter):
+
+        if filter is None:
+            yield from objects
+            return
 
         def _traverse(object, subfilter):
 
@@ -377,13 +481,47 @@ class Bvr:
 
             return keep
 
+        def _keywords(object, keywords):
+
+            text = "\n".join(SearchIndex.texts(object))
+            for _k in keywords:
+                found = re.search(r"\b" + re.escape(_k.lstrip("!")),
+                                  text, flags=re.IGNORECASE) is not None
+                if found == _k.startswith("!"):
+                    return False
+
+            return True
+
         for obj in objects:
 
-            keep = _traverse(obj, filter)
+            keep = _traverse(obj, filter) and (
+                "keywords" not in filter or _keywords(obj, filter["keywords"]))
             if keep:
-                filtered_objects.append(obj)
+                yield obj
+
+    def export_ndjson(self, objects, fields=None, out=sys.stdout):
+
+        def _project(obj, path):
+
+            value = obj
+            for _p in path.split("."):
+                if type(value) is dict:
+                    value = value.get(_p)
+                elif type(value) is list:
+                    value = next(
+                        (_e["value"] for _e in value if type(_e) is dict and _e.get("key") == _p), None)
+                else:
+                    return None
+
+            return value
+
+        for obj in objects:
+
+            if fields:
+                obj = {_f: _project(obj, _f) for _f in fields}
 
-        return filtered_objects
+            out.write(json.dumps(obj, separators=(",", ":")))
+            out.write("\n")
 
 
 if __name__ == "__main__":
@@ -396,6 +534,10 @@ if __name__ == "__main__":
         "--json", "-j", help="Ausgabe als JSON anstelle von HTML", action='store_true')
     parser.add_argument(
         "--csv", help="Ausgabe als CSV anstelle von HTML", action='store_true')
+    parser.add_argument(
+        "--ndjson", "-n", help="Ausgabe als NDJSON (ein Angebot pro Zeile) anstelle von HTML", action='store_true')
+    parser.add_argument(
+        "--fields", help="Kommagetrennte Felder für NDJSON, z.B. id,details.address.zipcode,details.properties.Zimmer")
     parser.add_argument(
         "--current", "-c", help="Ausgabe derzeitig gelistete Angebote anstatt nur neue", action='store_true')
     parser.add_argument(
@@ -404,8 +546,18 @@ if __name__ == "__main__":
         "--all", "-a", help="Verwende alle Angebote des Storage", action='store_true')
     parser.add_argument(
         "--empty", "-e", help="Lösche Immobilien im Storage", action='store_true')
+    parser.add_argument(
+        "--offline", "-o", help="Rufe keine Angebote ab, verwende nur den Storage", action='store_true')
     parser.add_argument(
         "--transient", "-t", help="Speichere Immobilien nicht im Storage", action='store_true')
+    parser.add_argument(
+        "--search", "-s", help="Volltextsuche im Storage statt Abruf der Angebote, z.B. \"Balkon AND Aufzug NOT WBS\"")
+    parser.add_argument(
+        "--record", help="Zeichne alle HTTP Abrufe und den Storage im Verzeichnis auf")
+    parser.add_argument(
+        "--replay", help="Spiele HTTP Abrufe und Storage aus dem Verzeichnis ohne Netzwerk ab")
+    parser.add_argument(
+        "--workers", "-w", help="Anzahl Prozesse zum Auswerten der Detailseiten", type=int, default=1)
     args = parser.parse_args()
 
     # load settings
@@ -419,13 +571,75 @@ if __name__ == "__main__":
         logging.log(logging.ERROR, "Setting file not valid")
         exit(1)
 
+    def render(objects, out=sys.stdout):
+
+        if args.ndjson:
+            # Ausgabe als NDJSON, jedes Angebot wird direkt nach dem Filtern geschrieben
+            bvr.export_ndjson(objects, out=out,
+                              fields=args.fields.split(",") if args.fields else None)
+            return
+
+        objects = list(objects)
+
+        if args.json:
+            # Ausgabe als JSON
+            print(json.dumps(objects, indent=2), file=out)
+        elif args.csv:
+            # Ausgabe als CSV
+            from mako.template import Template
+
+            t = Template(csv)
+            print(t.render(objects=objects,
+                  normalise=Bvr.normalise_properties), file=out)
+        elif len(objects) > 0:
+            # Ausgabe als HTML
+            from mako.template import Template
+
+            t = Template(template)
+            print(t.render(objects=objects), file=out)
+
     try:
-        bvr = Bvr(settings)
+        bvr = Bvr(settings, transient=args.transient or args.replay is not None)
+        bvr.workers = args.workers
+
+        if args.record:
+            bvr.http = HttpArchive(args.record, http=bvr.http)
+            if os.path.exists(bvr.storage_path):
+                shutil.copyfile(bvr.storage_path,
+                                os.path.join(args.record, "storage"))
+            if bvr.dedup is not None:
+                # Dubletten-Index zu Beginn des Laufs, auch wenn er noch leer ist
+                with open(os.path.join(args.record, "dedup"), "w") as f:
+                    f.write(json.dumps(bvr.dedup.entries, separators=(",", ":")))
+
+        if args.replay:
+            # Storage der Aufzeichnung verwenden und nichts zurückschreiben
+            bvr.http = HttpArchive(args.replay)
+            bvr.storage_path = os.path.join(args.replay, "storage")
+            bvr.load_storage()
+            bvr.search_index = None
+            bvr.dedup = DedupIndex(os.path.join(args.replay, "dedup")) if os.path.exists(
+                os.path.join(args.replay, "dedup")) else None
+            args.transient = True
+
+        if args.search:
+            if bvr.search_index is None:
+                logging.log(logging.ERROR, "Setting search_index missing")
+                exit(1)
+
+            try:
+                ids = bvr.search_index.search(args.search)
+            except ValueError as ex:
+                logging.log(logging.ERROR, str(ex))
+                exit(1)
+
+            render([bvr.storage[_id] for _id in ids if _id in bvr.storage])
+            exit(0)
 
         if args.empty:
             bvr.storage = {}
 
-        objects_from_listing = bvr.parse_objects_from_listing()
+        objects_from_listing = [] if args.offline else bvr.parse_objects_from_listing()
 
         objects_to_report = bvr.process_objects(
             objects_from_listing, args.current)
@@ -434,22 +648,12 @@ if __name__ == "__main__":
             bvr.store_json()
 
         if args.all:
-            objects_to_report = [o for o in bvr.storage.values()]
+            objects_to_report = bvr.storage.values()
 
         if settings["filter"] and not args.unfiltered:
-            objects_to_report = bvr.apply_filter(
+            objects_to_report = bvr.iter_filter(
                 objects_to_report, settings["filter"])
 
-        if args.json:
-            # Ausgabe als JSON
-            print(json.dumps(objects_to_report, indent=2))
-        elif args.csv:
-            # Ausgabe als CSV
-            t = Template(csv)
-            print(t.render(objects=objects_to_report))
-        elif len(objects_to_report) > 0:
-            # Ausgabe als HTML
-            t = Template(template)
-            print(t.render(objects=objects_to_report))
+        render(objects_to_report)
     except Exception as ex:
         print(str(ex), file=sys.stderr)
@@ -0,0 +1,26 @@
+#!/usr/bin/bash
+DIR="$(dirname "$0")"
+
+if [ $# -lt 1 ]
+then
+  echo -e "
+Saga Immobilien Suchagent mit E-Mailversand je Suchprofil.\n\
+\n\
+Usage: \n\
+  ./saga-profiles-email-notify.sh <settings file>\n\
+\n\
+Example: \n\
+  ./saga-profiles-email-notify.sh saga-settings-profiles.json\n\
+"
+  exit 1
+fi
+
+# $DIR/saga-suchagent.py $1 --formular | while IFS=$'\t' read -r NAME FILE RECIPIENT
+$DIR/saga-suchagent.py $1 | while IFS=$'\t' read -r NAME FILE RECIPIENT
+do
+  if [ -s ${FILE} ] && [ -n "${RECIPIENT}" ]
+  then
+     cat ${FILE} | recode UTF-8..ISO-8859-2 | mail -a "Content-Type: text/html; charset=ISO-8859-2; format=flowed" -s "Aktuelle Saga Angebote (${NAME})" ${RECIPIENT}
+  fi
+  rm -f ${FILE}
+done
@@ -1,21 +1,35 @@
 #!/usr/bin/python3
 # -*- coding: utf-8 -*-
 import argparse
+import codecs
+import glob
+import hashlib
 import json
 import logging
+import os
 import re
+import shutil
+import sys
+from collections.abc import MutableMapping
 from datetime import datetime, timedelta
+from html.parser import HTMLParser
 from pathlib import Path
 
-import urllib3
-from bs4 import BeautifulSoup
-from mako.template import Template
+from suchagent import DedupIndex, Fields, HttpArchive, Scheduler, SearchIndex
 
 template = """
 <html>
 <body>
-<h1>Aktuelle Saga Angebote</h1>
-% for o in objects:
+<h1>${title}</h1>
+% for f in fragments:
+${f}
+% endfor
+<small>Zusammengestellt von saga-suchagent, <a href="https://github.com/Heckie75/saga-suchagent">https://github.com/Heckie75/saga-suchagent</a><small>
+</body>
+</html>
+"""
+
+template_object = """
     <h2>${o["title"]}</h2>
 
     % if o["thumbnail"] is not None:
@@ -32,6 +46,7 @@ summary = o["short_descr"].replace("\\n", "<br>\\n")
     ${summary}
     </p>
 
+% if o["details"] is not None:
 <%
 addresse = o["details"]["descr"].replace("\\n", "<br>\\n")
 
@@ -87,6 +102,7 @@ else:
     <p>${a["text"]}</p>
     % endfor
     % endif
+% endif
 
     % if "application" in o:
     <h3>Bewerbung</h3>
@@ -110,44 +126,421 @@ else:
 
     <hr>
 
-% endfor
-<small>Zusammengestellt von saga-suchagent, <a href="https://github.com/Heckie75/saga-suchagent">https://github.com/Heckie75/saga-suchagent</a><small>
-</body>
-</html>
 """
 
 csv = """\\
 id\tTitel\tZimmer\tFlaeche\tGesamtmiete\tStrasse\tPLZ\tStadtteil\tOrt\tURL\terstellt\tzuletzt gesehen\\
 % for o in objects:
 <%
-zimmer =  list(filter(lambda p: p["key"] == "Zimmer", o["details"]["properties"]))[0]["value"]
-flaeche = list(filter(lambda p: p["key"] == "Wohnfl\u00e4che ca.", o["details"]["properties"]))[0]["value"]
-miete = list(filter(lambda p: p["key"] == "Gesamtmiete", o["details"]["properties"]))[0]["value"]
+details = o["details"] or {"properties": [], "address": None}
+fields = details.get("fields") or normalise(details["properties"])
+address = details["address"] or {}
 %>
-${o["id"]}\t${o["title"]}\t${zimmer}\t${flaeche}\t${miete}\t${o["details"]["address"]["street"]}\t${o["details"]["address"]["zipcode"]}\t${o["details"]["address"]["district"]}\t${o["details"]["address"]["city"]}\t${o["href"]}\t${o["first_seen"]}\t${o["last_seen"]}\\
+${o["id"]}\t${o["title"]}\t${fields["rooms"]}\t${fields["area_m2"]}\t${fields["rent_total"]}\t${address.get("street")}\t${address.get("zipcode")}\t${address.get("district")}\t${address.get("city")}\t${o["href"]}\t${o["first_seen"]}\t${o["last_seen"]}\\
 % endfor
 """
 
 
-class Saga:
+# Storage of all objects by id. In format "index" each object is stored in one
+# line "<id>\t<last_seen>\t<compact json>". Loading only indexes the offsets,
+# objects are decoded on first access and untouched ones are written verbatim.
+class Storage(MutableMapping):
+
+    def __init__(self, objects=None):
+
+        self._data = b""
+        self._entries = objects if objects is not None else {}
+        self._last_seen = {}
+
+    @staticmethod
+    def loads(data):
+
+        if data.lstrip()[:1] in [b"{", b""]:
+            return Storage(json.loads(data) if data.strip() else {})
+
+        storage = Storage()
+        storage._data = data
+
+        pos = 0
+        while pos < len(data):
+            end = data.find(b"\n", pos)
+            if end == -1:
+                end = len(data)
+
+            t1 = data.index(b"\t", pos, end)
+            t2 = data.index(b"\t", t1 + 1, end)
+            _id = data[pos:t1].decode("utf-8")
+            storage._entries[_id] = (t2 + 1, end)
+            storage._last_seen[_id] = data[t1 + 1:t2].decode("utf-8")
+            pos = end + 1
+
+        return storage
+
+    def dumps(self, format="json"):
+
+        if format != "index":
+            return json.dumps({k: self[k] for k in self}, indent=2).encode("utf-8")
+
+        lines = []
+        for _id, _entry in self._entries.items():
+            if type(_entry) is tuple:
+                _last_seen = self._last_seen[_id]
+                _json = self._data[_entry[0]:_entry[1]]
+            else:
+                _last_seen = _entry["last_seen"]
+                _json = json.dumps(
+                    _entry, separators=(",", ":")).encode("utf-8")
+
+            lines.append(b"\t".join(
+                [_id.encode("utf-8"), _last_seen.encode("utf-8"), _json]))
+
+        return b"\n".join(lines) + b"\n" if lines else b""
+
+    def last_seen(self, id):
+
+        if type(self._entries[id]) is tuple:
+            return self._last_seen[id]
+
+        return self._entries[id]["last_seen"]
+
+    def touch(self, id, last_seen):
+
+        if type(self._entries[id]) is tuple:
+            self._last_seen[id] = last_seen
+        else:
+            self._entries[id]["last_seen"] = last_seen
+
+    def __getitem__(self, id):
+
+        _entry = self._entries[id]
+        if type(_entry) is tuple:
+            _entry = json.loads(self._data[_entry[0]:_entry[1]])
+            _entry["last_seen"] = self._last_seen.pop(id)
+            self._entries[id] = _entry
+
+        return _entry
+
+    def __setitem__(self, id, obj):
+
+        self._last_seen.pop(id, None)
+        self._entries[id] = obj
+
+    def __delitem__(self, id):
+
+        self._last_seen.pop(id, None)
+        del self._entries[id]
+
+    def __contains__(self, id):
+
+        return id in self._entries
+
+    def __iter__(self):
+
+        return iter(list(self._entries))
+
+    def __len__(self):
+
+        return len(self._entries)
+
+    def clear(self):
+
+        self._data = b""
+        self._entries = {}
+        self._last_seen = {}
+
+
+# Storage split into a hot shard with the currently listed objects (stored at
+# the storage path) and cold shards per month "<path>.YYYY-MM" for objects no
+# longer listed. "<path>.cold" maps ids to their cold shard and every sighting
+# is appended as "<id>\t<timestamp>" to "<path>.sightings".
+class ShardedStorage(Storage):
+
+    def __init__(self, path):
+
+        super().__init__()
+
+        self.path = path
+        self._cold_index = {}
+        self._cold = {}
+        self._dirty = set()
+        self._sightings = []
+
+        try:
+            _hot = Storage.loads(open(self.path, "rb").read())
+            self._data, self._entries, self._last_seen = _hot._data, _hot._entries, _hot._last_seen
+        except FileNotFoundError:
+            pass
+        except ValueError:
+            pass
+
+        try:
+            for _line in open(self.path + ".cold", "r"):
+                _id, _month = _line.rstrip("\n").split("\t")
+                self._cold_index[_id] = _month
+        except FileNotFoundError:
+            pass
+
+    def _shard(self, month):
+
+        if month not in self._cold:
+            try:
+                self._cold[month] = Storage.loads(
+                    open("%s.%s" % (self.path, month), "rb").read())
+            except FileNotFoundError:
+                self._cold[month] = Storage()
+
+        return self._cold[month]
+
+    def _remove_cold(self, id):
+
+        _month = self._cold_index.pop(id)
+        _shard = self._shard(_month)
+        obj = _shard[id]
+        del _shard[id]
+        self._dirty.add(_month)
+
+        return obj
+
+    def rotate(self, listed):
+
+        for _id in list(self._entries):
+            if _id not in listed:
+                _month = self.last_seen(_id)[:7]
+                self._shard(_month)[_id] = super().__getitem__(_id)
+                super().__delitem__(_id)
+                self._cold_index[_id] = _month
+                self._dirty.add(_month)
+
+    def store(self):
+
+        f = open(self.path, "wb")
+        f.write(self.dumps("index"))
+        f.close()
+
+        for _month in self._dirty:
+            _filename = "%s.%s" % (self.path, _month)
+            if len(self._shard(_month)) > 0:
+                f = open(_filename, "wb")
+                f.write(self._shard(_month).dumps("index"))
+                f.close()
+            elif os.path.exists(_filename):
+                os.remove(_filename)
+
+        if len(self._dirty) > 0:
+            f = open(self.path + ".cold", "w")
+            f.writelines(["%s\t%s\n" % (_id, _month)
+                          for _id, _month in self._cold_index.items()])
+            f.close()
+
+        if len(self._sightings) > 0:
+            f = open(self.path + ".sightings", "a")
+            f.writelines(["%s\t%s\n" % _sighting for _sighting in self._sightings])
+            f.close()
+
+        self._dirty = set()
+        self._sightings = []
+
+    def last_seen(self, id):
+
+        if id in self._cold_index:
+            return self._shard(self._cold_index[id]).last_seen(id)
+
+        return super().last_seen(id)
+
+    def touch(self, id, last_seen):
+
+        if id in self._cold_index:
+            super().__setitem__(id, self._remove_cold(id))
+
+        # last_seen stays in the hot shard as well, reading it back from the
+        # growing sightings log would cost a full scan on every start
+        super().touch(id, last_seen)
+        self._sightings.append((id, last_seen))
+
+    def __getitem__(self, id):
+
+        # changes must be written back with __setitem__ to be stored
+        if id in self._cold_index:
+            return self._shard(self._cold_index[id])[id]
+
+        return super().__getitem__(id)
+
+    def __setitem__(self, id, obj):
+
+        if id in self._cold_index:
+            _month = self._cold_index[id]
+            self._shard(_month)[id] = obj
+            self._dirty.add(_month)
+            return
+        elif id not in self._entries and obj.get("last_seen"):
+            self._sightings.append((id, obj["last_seen"]))
+
+        super().__setitem__(id, obj)
+
+    def __delitem__(self, id):
+
+        if id in self._cold_index:
+            self._remove_cold(id)
+        else:
+            super().__delitem__(id)
+
+    def __contains__(self, id):
+
+        return id in self._entries or id in self._cold_index
+
+    def __iter__(self):
+
+        return iter(list(self._entries) + list(self._cold_index))
+
+    def __len__(self):
+
+        return len(self._entries) + len(self._cold_index)
+
+    def clear(self):
+
+        for _id in list(self._cold_index):
+            self._remove_cold(_id)
+
+        super().clear()
+
+
+# Incremental parser for the Saga listing. Teasers are collected in
+# self.teasers as soon as their div is closed, so the page is never held
+# in memory as a whole.
+class ListingParser(HTMLParser):
+
+    match_teaser = re.compile("teaser3 teaser3--listing.*")
+
+    def __init__(self):
+
+        super().__init__(convert_charrefs=True)
+        self.teasers = []
+        self._teaser = None
+        self._depth = 0
+        self._capture = None
+
+    def handle_starttag(self, tag, attrs):
+
+        attrs = dict(attrs)
+
+        if self._teaser is None:
+            if tag == "div" and self.match_teaser.search(attrs.get("class") or ""):
+                self._teaser = {"href": None, "img": None,
+                                "title": None, "short_descr": None}
+                self._depth = 1
+                self._in_a = False
+            return
+
+        if tag == "div":
+            self._depth += 1
+        elif tag == "a" and self._teaser["href"] is None:
+            self._teaser["href"] = attrs.get("href")
+            self._in_a = True
+        elif tag == "img" and self._teaser["img"] is None:
+            self._teaser["img"] = attrs.get("src")
+        elif tag == "h3" and self._in_a and self._teaser["title"] is None:
+            self._capture = ("title", "h3", [])
+        elif tag == "p" and self._teaser["short_descr"] is None and self._capture is None:
+            self._capture = ("short_descr", "p", [])
+
+    def handle_endtag(self, tag):
+
+        if self._teaser is None:
+            return
+
+        if self._capture and tag == self._capture[1]:
+            self._teaser[self._capture[0]] = "".join(self._capture[2])
+            self._capture = None
+        elif tag == "a":
+            self._in_a = False
+        elif tag == "div":
+            self._depth -= 1
+            if self._depth == 0:
+                self.teasers.append(self._teaser)
+                self._teaser = None
+
+    def handle_data(self, data):
+
+        if self._capture:
+            self._capture[2].append(data)
+
+
+# Cache of rendered html fragments per object, keyed by id and a hash of
+# everything the fragment shows, so unchanged objects are not rendered again.
+class FragmentCache:
+
+    def __init__(self, path):
+
+        self.path = path
+        os.makedirs(self.path, exist_ok=True)
+
+    def _filename(self, o):
+
+        _content = {_k: _v for _k, _v in o.items() if _k not in [
+            "first_seen", "last_seen", "reported"]}
+        _hash = hashlib.sha1(json.dumps(
+            _content, sort_keys=True).encode("utf-8")).hexdigest()
+
+        return os.path.join(self.path, "%s-%s.html" % (o["id"], _hash))
+
+    def get(self, o):
+
+        try:
+            with open(self._filename(o), "r") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def put(self, o, fragment):
+
+        for _file in glob.glob(os.path.join(self.path, glob.escape(o["id"]) + "-*.html")):
+            os.remove(_file)
+
+        with open(self._filename(o), "w") as f:
+            f.write(fragment)
+
+
+class Saga(Fields):
 
     YES = "Ja"
     NO = "Nein"
 
-    http = None
+    CONVERTABLE_PROPS = set(["Netto-Kalt-Miete", "Betriebskosten", "Heizkosten",
+                             "Gesamtmiete", "Zimmer", "Wohnfl\u00e4che ca.", "Etage"])
+
+    # provider specific property keys to canonical typed fields
+    FIELDS = {
+        "Zimmer": "rooms",
+        "Wohnfl\u00e4che ca.": "area_m2",
+        "Netto-Kalt-Miete": "rent_cold",
+        "Gesamtmiete": "rent_total",
+        "Etage": "floor",
+        "Baujahr": "year_built"
+    }
+
+    match_number = re.compile(r"([0-9\.,]+).*")
+
+    _http = None
+    politeness = None
     match_obj_id = None
     base_url = None
     url = None
     storage = None
     storage_path = None
+    storage_format = None
+    listed = None
     storage_changed = False
     filter = None
+    workers = 1
+    dedup = None
+    search_index = None
+    fragment_cache = None
+    profiles = None
 
     application = None
 
-    def __init__(self, settings):
+    def __init__(self, settings, transient=False):
 
-        self.http = urllib3.PoolManager()
         self.match_obj_id = re.compile(".+/([0-9\.]+)")
 
         # apply settings
@@ -158,22 +551,60 @@ class Saga:
         if self.storage_path.startswith("~"):
             self.storage_path = self.storage_path.replace(
                 "~", str(Path.home()))
+        self.politeness = settings.get("politeness", {})
+        self.storage_format = settings.get("storage_format", "json")
+
+        self.filter = settings.get("filter")
+        self.profiles = settings.get("profiles", {})
+        self.application = settings.get("application")
+
+        if settings.get("dedup"):
+            self.dedup = DedupIndex(
+                settings["dedup"].replace("~", str(Path.home())))
 
-        self.filter = settings["filter"]
+        if settings.get("fragment_cache"):
+            self.fragment_cache = FragmentCache(
+                settings["fragment_cache"].replace("~", str(Path.home())))
 
         # load storage
         self.load_storage()
 
+        if settings.get("search_index"):
+            self.search_index = SearchIndex(
+                settings["search_index"].replace("~", str(Path.home())), readonly=transient)
+            if len(self.search_index) == 0:
+                self.search_index.add(self.storage.values())
+
+    @property
+    def http(self):
+
+        if self._http is None:
+            import urllib3
+
+            self._http = Scheduler(urllib3.PoolManager(), **self.politeness)
+
+        return self._http
+
+    @http.setter
+    def http(self, http):
+
+        self._http = http
+
     def load_storage(self):
 
+        if self.storage_format == "sharded":
+            self.storage = ShardedStorage(self.storage_path)
+            self.storage_changed = False
+            return
+
         try:
-            data = open(self.storage_path, "r").read()
-            self.storage = json.loads(data)
+            data = open(self.storage_path, "rb").read()
+            self.storage = Storage.loads(data)
             self.storage_changed = False
         except FileNotFoundError:
-            self.storage = {}
+            self.storage = Storage()
         except ValueError:
-            self.storage = {}
+            self.storage = Storage()
 
     def store_json(self):
 
@@ -181,80 +612,435 @@ class Saga:
             return
 
         try:
-            f = open(self.storage_path, "w")
-            f.write(json.dumps(self.storage, indent=2))
-            f.close()
+            if isinstance(self.storage, ShardedStorage):
+                # objects not in the current listing move to the cold shards
+                if self.listed:
+                    self.storage.rotate(self.listed)
+                self.storage.store()
+            else:
+                f = open(self.storage_path, "wb")
+                f.write(self.storage.dumps(self.storage_format))
+                f.close()
             self.storage_changed = False
+
+            if self.dedup:
+                self.dedup.store()
         except FileNotFoundError:
-            self.storage = {}
+            self.storage = Storage()
 
     def parse_objects_from_listing(self):
 
-        objects = []
+        return list(self.iter_objects_from_listing())
 
-        request = self.http.request("GET", self.url)
-        try:
-            data = request.data.decode('utf-8')
-        except:
-            data = request.data.decode('latin-1')
+    def iter_objects_from_listing(self, chunk_size=16384):
 
-        soup = BeautifulSoup(data, 'html.parser')
+        request = self.http.request(
+            "GET", self.url, preload_content=False)
 
-        for div in soup.find_all('div', attrs={"class": re.compile("teaser3 teaser3--listing.*")}):
+        parser = ListingParser()
+        decoder = None
 
-            _obj_id = self.match_obj_id.match(div.a["href"])
+        for chunk in request.stream(chunk_size):
 
-            if div.find("img"):
-                _thumbnail = self.base_url + div.find("img")["src"]
-            else:
-                _thumbnail = None
+            if decoder is None:
+                # charset from header, meta tag of the first chunk or utf-8
+                _match = re.search(r"charset=[\"']?([\w-]+)", request.headers.get("content-type", "")) or re.search(
+                    rb"<meta[^>]+charset=[\"']?([\w-]+)", chunk, flags=re.IGNORECASE)
+                _charset = _match.group(1) if _match else "utf-8"
+                if type(_charset) is bytes:
+                    _charset = _charset.decode("ascii")
+                try:
+                    decoder = codecs.getincrementaldecoder(_charset)()
+                except LookupError:
+                    decoder = codecs.getincrementaldecoder("utf-8")()
 
-            objects.append(
-                {
-                    "id": _obj_id.group(1),
-                    "ref": _obj_id.group(1).split("."),
-                    "title": div.a.h3.text,
-                    "thumbnail": _thumbnail,
-                    "href": self.base_url + div.a["href"],
-                    "short_descr": div.p.text.strip(),
-                    "details": None,
-                    "first_seen": None,
-                    "last_seen": None
-                }
-            )
+            pending = decoder.getstate()[0]
+            try:
+                parser.feed(decoder.decode(chunk))
+            except UnicodeDecodeError:
+                # bytes held back from the previous chunk are decoded again
+                decoder = codecs.getincrementaldecoder("latin-1")()
+                parser.feed(decoder.decode(pending + chunk))
 
-        return objects
+            yield from self._objects_from_teasers(parser)
 
-    def process_objects(self, objects, current=False):
+        if decoder:
+            parser.feed(decoder.decode(b"", final=True))
+        parser.close()
+        request.release_conn()
 
-        def _now():
-            return datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        yield from self._objects_from_teasers(parser)
+
+    def _objects_from_teasers(self, parser):
+
+        while len(parser.teasers) > 0:
+
+            _teaser = parser.teasers.pop(0)
+            _obj_id = self.match_obj_id.match(_teaser["href"])
+
+            yield {
+                "id": _obj_id.group(1),
+                "ref": _obj_id.group(1).split("."),
+                "title": _teaser["title"],
+                "thumbnail": self.base_url + _teaser["img"] if _teaser["img"] else None,
+                "href": self.base_url + _teaser["href"],
+                "short_descr": (_teaser["short_descr"] or "").strip(),
+                "details": None,
+                "first_seen": None,
+                "last_seen": None
+            }
+
+    def process_objects(self, objects, current=False, prefilter=True):
 
         current_objects = []
+        new_objects = []
+        new_ids = set()
+
+        refs = self.index_refs()
+        filters = self.active_filters() if prefilter else []
+
+        if len(objects) > 0:
+            self.listed = set([o["id"] for o in objects])
 
         for o in objects:
 
+            _previous = None if o["id"] in self.storage else self.find_relisted(
+                o, refs)
+
             if o["id"] in self.storage:
 
-                if current or datetime.strptime(self.storage[o["id"]]["last_seen"], "%Y-%m-%d %H:%M:%S") < datetime.now() - timedelta(days=7):
-                    current_objects.append(self.storage[o["id"]])
+                _o = self.revisit_object(o["id"], current)
+                if _o:
+                    current_objects.append(_o)
+
+            elif _previous:
 
-                self.storage[o["id"]]["last_seen"] = _now()
+                if self.store_object(o, json.loads(json.dumps(_previous["details"])),
+                                     _previous.get("duplicate_of", _previous["id"])):
+                    current_objects.append(o)
+
+            elif o["id"] in new_ids:
+                continue
+
+            elif len(filters) > 0 and not any([self.match_teaser(o, _f) for _f in filters]):
+                self.store_stub(o)
 
             else:
-                details = self.parse_details(o["href"])
-                o["details"] = details
-                o["first_seen"] = _now()
-                o["last_seen"] = o["first_seen"]
-                self.storage[o["id"]] = o
-                current_objects.append(o)
+                new_objects.append(o)
+                new_ids.add(o["id"])
+
+        # fetch details of likely matches first
+        bounds = [self.filter_bounds(self.filter)] + \
+            [self.filter_bounds(p.get("filter")) for p in self.profiles.values()]
+        new_objects.sort(key=lambda o: max(
+            [self.match_likelihood(o, _b) for _b in bounds]), reverse=True)
 
-            self.storage_changed = True
+        if self.workers <= 1:
+
+            for o in new_objects:
+                if self.store_object(o, self.parse_details(o["href"])):
+                    current_objects.append(o)
+
+        elif len(new_objects) > 0:
+
+            from concurrent.futures import ProcessPoolExecutor
+
+            # fetch details here, parse them in worker processes
+            with ProcessPoolExecutor(max_workers=self.workers) as executor:
+
+                futures = []
+                for o in new_objects:
+                    request = self.http.request("GET", o["href"])
+                    futures.append(executor.submit(
+                        Saga.parse_details_html, self.base_url, request.data))
+
+                for o, future in zip(new_objects, futures):
+                    if self.store_object(o, future.result()):
+                        current_objects.append(o)
+
+        # report in listing order
+        order = {}
+        for i, o in enumerate(objects):
+            order.setdefault(o["id"], i)
+        current_objects.sort(key=lambda o: order[o["id"]])
 
         return current_objects
 
+    async def pipeline(self, current=False, filter=None, formular=False, maxsize=8):
+
+        import asyncio
+
+        async def _pipe(source, func, concurrency=1):
+
+            inbox = asyncio.Queue(maxsize=maxsize)
+            outbox = asyncio.Queue(maxsize=maxsize)
+
+            async def _feed():
+                try:
+                    async for o in source:
+                        await inbox.put(o)
+                except Exception as ex:
+                    await outbox.put(ex)
+                for _ in range(concurrency):
+                    await inbox.put(None)
+
+            async def _work():
+                try:
+                    o = await inbox.get()
+                    while o is not None:
+                        o = await func(o)
+                        if o is not None:
+                            await outbox.put(o)
+                        o = await inbox.get()
+                except Exception as ex:
+                    await outbox.put(ex)
+                await outbox.put(None)
+
+            tasks = [asyncio.create_task(_feed())] + \
+                [asyncio.create_task(_work()) for _ in range(concurrency)]
+            try:
+                running = concurrency
+                while running > 0:
+                    o = await outbox.get()
+                    if o is None:
+                        running -= 1
+                    elif isinstance(o, Exception):
+                        raise o
+                    else:
+                        yield o
+            finally:
+                for _task in tasks:
+                    _task.cancel()
+
+        async def _listing():
+            self.listed = set()
+            listing = self.iter_objects_from_listing()
+            o = await asyncio.to_thread(next, listing, None)
+            while o is not None:
+                self.listed.add(o["id"])
+                yield o
+                o = await asyncio.to_thread(next, listing, None)
+
+        refs = self.index_refs()
+        pending = set()
+
+        async def _process(o):
+
+            if o["id"] in self.storage:
+                o = self.revisit_object(o["id"], current)
+                if o and o["details"] is None:
+                    if filter and not self.match_teaser(o, filter):
+                        return None
+                    # only fetching runs in a thread, storing stays on the loop
+                    details = await asyncio.to_thread(self.fetch_details, o)
+                    if details is None or not self.complete_object(o, details):
+                        return None
+                return o
+            elif o["id"] in pending:
+                return None
+
+            pending.add(o["id"])
+
+            _previous = self.find_relisted(o, refs)
+            if not _previous and filter and not self.match_teaser(o, filter):
+                self.store_stub(o)
+                return None
+            elif _previous:
+                details = json.loads(json.dumps(_previous["details"]))
+                duplicate = _previous.get("duplicate_of", _previous["id"])
+            else:
+                details = await asyncio.to_thread(self.parse_details, o["href"])
+                duplicate = None
+
+            return o if self.store_object(o, details, duplicate) else None
+
+        async def _filter(o):
+            return next(self.iter_filter([o], filter), None)
+
+        async def _apply(o):
+            return await asyncio.to_thread(lambda: next(self.iter_application([o])))
+
+        stream = _pipe(_listing(), _process, concurrency=max(self.workers, 4))
+        stream = _pipe(stream, _filter)
+        if formular:
+            stream = _pipe(stream, _apply)
+
+        async for o in stream:
+            yield o
+
+    def active_filters(self):
+
+        if self.profiles:
+            return [p.get("filter") for p in self.profiles.values()]
+
+        return [self.filter]
+
+    def match_teaser(self, o, filter):
+
+        if filter is None:
+            return True
+
+        # clauses on listing fields like title or short_descr
+        _listing = {_k: _v for _k, _v in filter.items() if _k in [
+            "id", "title", "short_descr", "href"]}
+        if len(_listing) > 0 and len(self.apply_filter([o], _listing)) == 0:
+            return False
+
+        fields = self.teaser_fields(o)
+        for _field, (_lo, _hi) in self.filter_bounds(filter).items():
+            if _field in fields and not _lo <= fields[_field] <= _hi:
+                return False
+
+        text = " ".join([o.get("title") or "", o.get("short_descr") or ""])
+
+        _zipcode = re.search(r"\b(\d{5})\b", text)
+        _regex = filter.get("details", {}).get("address", {}).get("zipcode")
+        if _zipcode and type(_regex) is str and re.match(_regex, _zipcode.group(1)) is None:
+            return False
+
+        for _k in filter.get("keywords", []):
+            if _k.startswith("!") and re.search(r"\b" + re.escape(_k[1:]), text, flags=re.IGNORECASE):
+                return False
+
+        return True
+
+    def store_stub(self, o):
+
+        # clearly not matching, details are fetched later if ever needed
+        o["details"] = None
+        o["first_seen"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        o["last_seen"] = o["first_seen"]
+
+        if self.search_index is not None:
+            self.search_index.add([o])
+
+        self.storage[o["id"]] = o
+        self.storage_changed = True
+
+    def fetch_details(self, o):
+
+        # details of a stub, None if the page is gone or not readable
+        try:
+            request = self.http.request("GET", o["href"])
+            if request.status == 200:
+                return Saga.parse_details_html(self.base_url, request.data)
+        except Exception as ex:
+            logging.log(logging.WARNING, "Details of %s not readable: %s" % (o["id"], ex))
+
+        return None
+
+    def complete_object(self, o, details=None):
+
+        details = details if details is not None else self.fetch_details(o)
+        if details is None:
+            return False
+
+        first_seen, last_seen = o["first_seen"], o["last_seen"]
+        reportable = self.store_object(o, details)
+        o["first_seen"], o["last_seen"] = first_seen, last_seen
+        self.storage[o["id"]] = o
+
+        return reportable
+
+    def iter_complete(self, objects, filters=None):
+
+        for o in objects:
+
+            if o["details"] is None:
+                # only stubs of the current listing are completed, others
+                # stay stubs and are not reported
+                if not self.listed or o["id"] not in self.listed:
+                    continue
+                if filters and not any([self.match_teaser(o, _f) for _f in filters]):
+                    continue
+                if not self.complete_object(o):
+                    continue
+
+            yield o
+
+    def revisit_object(self, id, current=False):
+
+        now = datetime.now()
+        report = current or datetime.strptime(self.storage.last_seen(
+            id), "%Y-%m-%d %H:%M:%S") < now - timedelta(days=7)
+
+        self.storage.touch(id, now.strftime("%Y-%m-%d %H:%M:%S"))
+        self.storage_changed = True
+
+        return self.storage[id] if report else None
+
+    def store_object(self, o, details, duplicate=None):
+
+        o["details"] = details
+        o["first_seen"] = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        o["last_seen"] = o["first_seen"]
+
+        if self.dedup:
+            duplicate = self.dedup.link(o) or duplicate
+
+        if self.search_index is not None:
+            self.search_index.add([o])
+
+        if duplicate:
+            o["duplicate_of"] = duplicate
+
+        self.storage[o["id"]] = o
+        self.storage_changed = True
+
+        return duplicate is None
+
+    def index_refs(self):
+
+        # same flat re-listed under a new id suffix, e.g. 82107.0011.2100
+        refs = {}
+        if self.dedup:
+            for _id in self.storage:
+                refs.setdefault(".".join(_id.split(".")[:2]), []).append(_id)
+
+        return refs
+
+    def find_relisted(self, o, refs):
+
+        for _id in refs.get(".".join(o["ref"][:2]), []):
+            _previous = self.storage[_id]
+            # stubs have no details to take over
+            if _previous["details"] is not None and _previous["title"] == o["title"]:
+                return _previous
+
+        return None
+
+    def process_profiles(self, objects, new_objects, current=False, unfiltered=False):
+
+        now = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
+        new_ids = set([o["id"] for o in new_objects])
+
+        reports = {}
+
+        for name, profile in self.profiles.items():
+
+            candidates = [o for o in objects if "duplicate_of" not in o and (
+                current or o["id"] in new_ids or name not in o.get("reported", {}))]
+
+            if not unfiltered:
+                candidates = self.apply_filter(candidates, profile.get("filter"))
+
+            for o in candidates:
+                o.setdefault("reported", {})[name] = now
+                self.storage[o["id"]] = o
+                self.storage_changed = True
+
+            reports[name] = candidates
+
+        return reports
+
     def parse_details(self, url):
 
+        request = self.http.request("GET", url)
+        return Saga.parse_details_html(self.base_url, request.data)
+
+    @classmethod
+    def parse_details_html(cls, base_url, data):
+
         def _parse_descr(descr):
 
             address = {
@@ -289,17 +1075,14 @@ class Saga:
 
         def _convert_property(key, value):
 
-            _convertable_props = ["Netto-Kalt-Miete", "Betriebskosten",
-                                  "Heizkosten", "Gesamtmiete", "Zimmer", "Wohnfl\u00e4che ca.", "Etage"]
-
             def _converter(s):
                 s = s.replace(" 1/2", ",5")
-                match = re.match(r"([0-9\.,]+).*", s)
+                match = cls.match_number.match(s)
                 return float(match.group(1).replace(".", "").replace(",", ".")) if match else 0
 
-            if value in [self.YES, self.NO]:
-                return value == self.YES
-            elif key in _convertable_props:
+            if value in [cls.YES, cls.NO]:
+                return value == cls.YES
+            elif key in cls.CONVERTABLE_PROPS:
                 return _converter(value)
             else:
                 return value
@@ -314,8 +1097,10 @@ class Saga:
             "area": []
         }
 
-        request = self.http.request("GET", url)
-        data = request.data.decode('utf-8')
+        data = data.decode('utf-8')
+
+        from bs4 import BeautifulSoup
+
         soup = BeautifulSoup(data, 'html.parser')
 
         # image gallery
@@ -325,7 +1110,7 @@ class Saga:
             for _item in _image_gallery.find_all("a", attrs={"class": re.compile("rsImg.*")}):
                 details["images"].append(
                     {
-                        "img": self.base_url + _item["href"],
+                        "img": base_url + _item["href"],
                         "alt": _item.img["alt"] if _item.img.has_attr("alt") else ""
                     }
                 )
@@ -353,8 +1138,8 @@ class Saga:
 
                 text = prop.text
                 if text == "" and prop.has_attr("class"):
-                    text = self.YES if (
-                        prop["class"] == "checked") else self.NO
+                    text = cls.YES if (
+                        prop["class"] == "checked") else cls.NO
 
                 value = _convert_property(key, text)
 
@@ -385,6 +1170,8 @@ class Saga:
                 }
             )
 
+        details["fields"] = cls.normalise_properties(details["properties"])
+
         return details
 
     def apply_filter(self, objects, filter=filter):
@@ -392,7 +1179,13 @@ class Saga:
         if filter is None:
             return objects
 
-        filtered_objects = []
+        return list(self.iter_filter(objects, filter))
+
+    def iter_filter(self, objects, filter=filter):
+
+        if filter is None:
+            yield from objects
+            return
 
         def _traverse(object, subfilter):
 
@@ -436,16 +1229,76 @@ class Saga:
 
             return keep
 
+        def _keywords(object, keywords):
+
+            text = "\n".join(SearchIndex.texts(object))
+            for _k in keywords:
+                found = re.search(r"\b" + re.escape(_k.lstrip("!")),
+                                  text, flags=re.IGNORECASE) is not None
+                if found == _k.startswith("!"):
+                    return False
+
+            return True
+
         for obj in objects:
 
-            keep = _traverse(obj, filter)
+            keep = _traverse(obj, filter) and (
+                "keywords" not in filter or _keywords(obj, filter["keywords"]))
             if keep:
-                filtered_objects.append(obj)
+                yield obj
+
+    def export_ndjson(self, objects, fields=None, out=sys.stdout):
+
+        def _project(obj, path):
+
+            value = obj
+            for _p in path.split("."):
+                if type(value) is dict:
+                    value = value.get(_p)
+                elif type(value) is list:
+                    value = next(
+                        (_e["value"] for _e in value if type(_e) is dict and _e.get("key") == _p), None)
+                else:
+                    return None
+
+            return value
+
+        for obj in objects:
 
-        return filtered_objects
+            if fields:
+                obj = {_f: _project(obj, _f) for _f in fields}
+
+            out.write(json.dumps(obj, separators=(",", ":")))
+            out.write("\n")
+
+    def render_html(self, objects, title="Aktuelle Saga Angebote"):
+
+        from mako.template import Template
+
+        fragments = []
+        _template = None
+
+        for o in objects:
+
+            fragment = self.fragment_cache.get(o) if self.fragment_cache else None
+            if fragment is None:
+                if _template is None:
+                    _template = Template(template_object)
+                fragment = _template.render(o=o)
+                if self.fragment_cache:
+                    self.fragment_cache.put(o, fragment)
+
+            fragments.append(fragment)
+
+        return Template(template).render(title=title, fragments=fragments)
 
     def send_application(self, objects):
 
+        for o in self.iter_application(objects):
+            pass
+
+    def iter_application(self, objects):
+
         for o in objects:
 
             fields = {
@@ -491,6 +1344,8 @@ class Saga:
                 "response": response.data.decode('utf-8')
             }
 
+            yield o
+
 
 if __name__ == "__main__":
 
@@ -502,6 +1357,10 @@ if __name__ == "__main__":
         "--json", "-j", help="Ausgabe als JSON anstelle von HTML", action='store_true')
     parser.add_argument(
         "--csv", help="Ausgabe als CSV anstelle von HTML", action='store_true')
+    parser.add_argument(
+        "--ndjson", "-n", help="Ausgabe als NDJSON (ein Angebot pro Zeile) anstelle von HTML", action='store_true')
+    parser.add_argument(
+        "--fields", help="Kommagetrennte Felder für NDJSON, z.B. id,details.address.zipcode,details.properties.Zimmer")
     parser.add_argument(
         "--current", "-c", help="Ausgabe derzeitig gelistete Angebote anstatt nur neue", action='store_true')
     parser.add_argument(
@@ -512,8 +1371,22 @@ if __name__ == "__main__":
         "--empty", "-e", help="Lösche Immobilien im Storage", action='store_true')
     parser.add_argument(
         "--formular", "-f", help="Sende Formular für Bewerbung", action='store_true')
+    parser.add_argument(
+        "--digest", "-d", help="Zusammenfassung aller neuen Angebote des letzten Tages oder der letzten Woche", choices=["day", "week"])
+    parser.add_argument(
+        "--offline", "-o", help="Rufe keine Angebote ab, verwende nur den Storage", action='store_true')
     parser.add_argument(
         "--transient", "-t", help="Speichere Immobilien nicht im Storage", action='store_true')
+    parser.add_argument(
+        "--search", "-s", help="Volltextsuche im Storage statt Abruf der Angebote, z.B. \"Balkon AND Aufzug NOT WBS\"")
+    parser.add_argument(
+        "--pipeline", "-p", help="Verarbeite jedes Angebot sofort nach Abruf der Details", action='store_true')
+    parser.add_argument(
+        "--record", help="Zeichne alle HTTP Abrufe und den Storage im Verzeichnis auf")
+    parser.add_argument(
+        "--replay", help="Spiele HTTP Abrufe und Storage aus dem Verzeichnis ohne Netzwerk ab")
+    parser.add_argument(
+        "--workers", "-w", help="Anzahl Prozesse zum Auswerten der Detailseiten", type=int, default=1)
     args = parser.parse_args()
 
     # load settings
@@ -527,36 +1400,175 @@ if __name__ == "__main__":
         logging.log(logging.ERROR, "Setting file not valid")
         exit(1)
 
-    saga = Saga(settings)
+    def render(objects, out=sys.stdout, title="Aktuelle Saga Angebote"):
+
+        if args.ndjson:
+            # Ausgabe als NDJSON, jedes Angebot wird direkt nach dem Filtern geschrieben
+            saga.export_ndjson(objects, out=out,
+                               fields=args.fields.split(",") if args.fields else None)
+            return
+
+        objects = list(objects)
+
+        if args.json:
+            # Ausgabe als JSON
+            print(json.dumps(objects, indent=2), file=out)
+        elif args.csv:
+            # Ausgabe als CSV
+            from mako.template import Template
+
+            t = Template(csv)
+            print(t.render(objects=objects,
+                  normalise=Saga.normalise_properties), file=out)
+        elif len(objects) > 0:
+            # Ausgabe als HTML
+            print(saga.render_html(objects, title=title), file=out)
+
+    saga = Saga(settings, transient=args.transient or args.replay is not None)
+    saga.workers = args.workers
+
+    if args.digest and saga.profiles:
+        logging.log(logging.ERROR, "Option digest not supported with profiles")
+        exit(1)
+
+    if args.record:
+        saga.http = HttpArchive(args.record, http=saga.http)
+        for _file in glob.glob(glob.escape(saga.storage_path) + "*"):
+            shutil.copyfile(_file, os.path.join(
+                args.record, "storage" + _file[len(saga.storage_path):]))
+        if saga.dedup is not None:
+            # Dubletten-Index zu Beginn des Laufs, auch wenn er noch leer ist
+            with open(os.path.join(args.record, "dedup"), "w") as f:
+                f.write(json.dumps(saga.dedup.entries, separators=(",", ":")))
+
+    if args.replay:
+        # Storage der Aufzeichnung verwenden und nichts zurückschreiben
+        saga.http = HttpArchive(args.replay)
+        saga.storage_path = os.path.join(args.replay, "storage")
+        saga.load_storage()
+        saga.search_index = None
+        saga.dedup = DedupIndex(os.path.join(args.replay, "dedup")) if os.path.exists(
+            os.path.join(args.replay, "dedup")) else None
+        saga.fragment_cache = None
+        args.transient = True
+
+    if args.search:
+        if saga.search_index is None:
+            logging.log(logging.ERROR, "Setting search_index missing")
+            exit(1)
+
+        try:
+            ids = saga.search_index.search(args.search)
+        except ValueError as ex:
+            logging.log(logging.ERROR, str(ex))
+            exit(1)
+
+        # Angebote ohne Details nur mit den Angaben aus der Angebotsliste
+        render([saga.storage[_id] for _id in ids if _id in saga.storage])
+        exit(0)
 
     if args.empty:
-        saga.storage = {}
+        saga.storage.clear()
+
+    if args.pipeline and not (saga.profiles or args.offline or args.all or args.digest):
+        # Angebote laufen einzeln durch Details, Filter, Bewerbung und Ausgabe
+        async def _run():
+
+            objects = []
+            async for o in saga.pipeline(current=args.current,
+                                         filter=None if args.unfiltered else settings.get(
+                                             "filter"),
+                                         formular=args.formular):
+                if args.ndjson:
+                    render([o])
+                    sys.stdout.flush()
+                else:
+                    objects.append(o)
+
+            return objects
+
+        import asyncio
+
+        objects_to_report = asyncio.run(_run())
+
+        if not args.transient:
+            saga.store_json()
 
-    objects_from_listing = saga.parse_objects_from_listing()
+        if not args.ndjson:
+            render(objects_to_report)
+
+        exit(0)
+
+    objects_from_listing = [] if args.offline else saga.parse_objects_from_listing()
     objects_to_report = saga.process_objects(
-        objects_from_listing, args.current)
+        objects_from_listing, args.current, prefilter=not args.unfiltered)
+
+    if saga.profiles:
+        # Ein Bericht je Suchprofil, Ausgabe in die Datei des Profils
+        if args.all:
+            objects_listed = saga.storage.values()
+        else:
+            objects_listed = [saga.storage[o["id"]]
+                              for o in objects_from_listing]
+
+        objects_listed = list(saga.iter_complete(
+            objects_listed, None if args.unfiltered else saga.active_filters()))
+
+        reports = saga.process_profiles(
+            objects_listed, objects_to_report, current=args.current or args.all, unfiltered=args.unfiltered)
+
+        for name, objects in reports.items():
+
+            profile = saga.profiles[name]
+            output = profile["output"].replace("~", str(Path.home()))
+
+            if args.formular and len(objects) > 0:
+                saga.application = profile.get(
+                    "application", settings.get("application"))
+                objects = list(saga.iter_application(objects))
+
+            if len(objects) == 0:
+                Path(output).unlink(missing_ok=True)
+                continue
+
+            with open(output, "w") as f:
+                render(objects, out=f)
+
+            print("%s\t%s\t%s" % (name, output, profile.get("recipient", "")))
+
+        if not args.transient:
+            saga.store_json()
+
+        exit(0)
 
     if not args.transient:
         saga.store_json()
 
     if args.all:
-        objects_to_report = [o for o in saga.storage.values()]
+        objects_to_report = saga.storage.values()
+
+    if args.digest:
+        since = (datetime.now() - timedelta(days=1 if args.digest == "day" else 7)
+                 ).strftime("%Y-%m-%d %H:%M:%S")
+        objects_to_report = [o for o in saga.storage.values(
+        ) if o["first_seen"] >= since and "duplicate_of" not in o]
+
+    objects_to_report = saga.iter_complete(
+        objects_to_report, None if args.unfiltered else [settings.get("filter")])
 
-    if settings["filter"] and not args.unfiltered:
-        objects_to_report = saga.apply_filter(
+    if settings.get("filter") and not args.unfiltered:
+        objects_to_report = saga.iter_filter(
             objects_to_report, settings["filter"])
 
     if args.formular:
-        saga.send_application(objects_to_report)
-
-    if args.json:
-        # Ausgabe als JSON
-        print(json.dumps(objects_to_report, indent=2))
-    elif args.csv:
-        # Ausgabe als CSV
-        t = Template(csv)
-        print(t.render(objects=objects_to_report))
-    elif len(objects_to_report) > 0:
-        # Ausgabe als HTML
-        t = Template(template)
-        print(t.render(objects=objects_to_report))
+        objects_to_report = saga.iter_application(objects_to_report)
+
+    if args.digest:
+        render(objects_to_report, title="Saga Angebote %s" % (
+            "des letzten Tages" if args.digest == "day" else "der letzten Woche"))
+    else:
+        render(objects_to_report)
+
+    if not args.transient:
+        # Details von Angeboten, die erst jetzt abgerufen wurden
+        saga.store_json()
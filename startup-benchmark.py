@@ -0,0 +1,59 @@
+#!/usr/bin/python3
+# -*- coding: utf-8 -*-
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+import time
+
+if __name__ == "__main__":
+
+    # args
+    parser = argparse.ArgumentParser(
+        description="Miss die Startzeit des Suchagenten ohne Netzwerkzugriff")
+    parser.add_argument("settings", help="Angabe der Datei mit Einstellungen")
+    parser.add_argument(
+        "--agent", help="Suchagent, der gemessen wird", default=os.path.join(os.path.dirname(os.path.abspath(__file__)), "saga-suchagent.py"))
+    parser.add_argument(
+        "--runs", "-r", help="Anzahl der Durchläufe", type=int, default=10)
+    parser.add_argument(
+        "--imports", "-i", help="Zeige die langsamsten Imports", type=int, default=10)
+    args = parser.parse_args()
+
+    command = [sys.executable, args.agent, args.settings,
+               "--offline", "--all", "--transient", "--ndjson", "--fields", "id"]
+
+    # Baseline: nackter Interpreter
+    baseline = []
+    for _ in range(args.runs):
+        start = time.perf_counter()
+        subprocess.run([sys.executable, "-c", "pass"], check=True)
+        baseline.append(time.perf_counter() - start)
+
+    timings = []
+    for _ in range(args.runs):
+        start = time.perf_counter()
+        subprocess.run(command, check=True, stdout=subprocess.DEVNULL)
+        timings.append(time.perf_counter() - start)
+
+    print("Interpreter: min %.1f ms, median %.1f ms" %
+          (min(baseline) * 1000, statistics.median(baseline) * 1000))
+    print("Suchagent:   min %.1f ms, median %.1f ms" %
+          (min(timings) * 1000, statistics.median(timings) * 1000))
+
+    if args.imports > 0:
+        # kumulierte Importzeiten aus python -X importtime
+        result = subprocess.run([sys.executable, "-X", "importtime"] + command[1:],
+                                check=True, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+
+        imports = []
+        for line in result.stderr.splitlines():
+            if line.startswith("import time:") and "|" in line and "cumulative" not in line:
+                _self, _cumulative, _module = line[len("import time:"):].split("|")
+                if not _module.startswith("  "):
+                    imports.append((int(_cumulative), _module.strip()))
+
+        print("\nLangsamste Imports (kumuliert):")
+        for _cumulative, _module in sorted(imports, reverse=True)[:args.imports]:
+            print("%8.1f ms  %s" % (_cumulative / 1000, _module))
@@ -0,0 +1,463 @@
+# -*- coding: utf-8 -*-
+# Infrastructure shared by saga-suchagent.py and bvr-suchagent.py
+import gzip
+import hashlib
+import io
+import json
+import math
+import os
+import re
+import threading
+import time
+import urllib.parse
+from datetime import datetime, timezone
+
+
+# Advisory file lock, only available on Unix. On Windows the file is used
+# without locking.
+def _lock(f, exclusive=True):
+
+    try:
+        import fcntl
+    except ImportError:
+        return
+
+    fcntl.flock(f, fcntl.LOCK_EX if exclusive else fcntl.LOCK_SH)
+
+
+# Index of similarity hashes to link near-duplicate listings. The 64 bit
+# simhash is split into bands, so candidates are found by exact band lookups.
+class DedupIndex:
+
+    BANDS = 4
+    MAX_DISTANCE = 3
+    MAX_METERS = 50
+
+    def __init__(self, path):
+
+        self.path = path
+        self.entries = {}
+        self.bands = {}
+        self.added = {}
+
+        try:
+            with open(self.path, "r") as f:
+                _lock(f, exclusive=False)
+                for _id, _entry in json.loads(f.read()).items():
+                    self._index(_id, _entry)
+        except FileNotFoundError:
+            pass
+        except ValueError:
+            pass
+
+    @staticmethod
+    def simhash(obj):
+
+        tokens = []
+
+        _address = obj["details"].get("address") or {}
+        for _k in ["street", "zipcode"]:
+            if _address.get(_k):
+                tokens.append("%s:%s" % (_k, _address[_k].lower()))
+
+        _fields = obj["details"].get("fields") or {}
+        for _k, _step in [("rooms", 0.5), ("area_m2", 5), ("rent_total", 25)]:
+            if _fields.get(_k):
+                tokens.append("%s:%i" % (_k, _fields[_k] // _step))
+
+        _texts = [obj.get("short_descr") or "", obj["details"].get("descr") or ""]
+        _texts += [_a["text"] for _a in obj["details"].get("additions", [])]
+        for _text in _texts:
+            tokens += re.findall(r"\w{3,}", re.sub("<[^>]+>", " ", _text).lower())
+
+        vector = [0] * 64
+        for _token in tokens:
+            _h = int.from_bytes(hashlib.md5(
+                _token.encode("utf-8")).digest()[:8], "big")
+            for i in range(64):
+                vector[i] += 1 if _h >> i & 1 else -1
+
+        return sum(1 << i for i in range(64) if vector[i] > 0)
+
+    def _bands(self, hash):
+
+        bits = 64 // self.BANDS
+        return ["%i:%x" % (i, hash >> (i * bits) & ((1 << bits) - 1)) for i in range(self.BANDS)]
+
+    def _index(self, id, entry):
+
+        self.entries[id] = entry
+        for _band in self._bands(entry[0]):
+            self.bands.setdefault(_band, []).append(id)
+
+    def link(self, obj):
+
+        hash = DedupIndex.simhash(obj)
+        coords = obj["details"].get("coords")
+        lat, lng = (coords[0]["lat"], coords[0]["lng"]) if coords else (None, None)
+
+        duplicate = None
+        for _band in self._bands(hash):
+            for _id in self.bands.get(_band, []):
+                _hash, _lat, _lng = self.entries[_id]
+                if _id == obj["id"] or bin(hash ^ _hash).count("1") > self.MAX_DISTANCE:
+                    continue
+
+                if lat is not None and _lat is not None:
+                    _dy = (float(lat) - float(_lat)) * 111320
+                    _dx = (float(lng) - float(_lng)) * 111320 * \
+                        math.cos(math.radians(float(lat)))
+                    if math.hypot(_dx, _dy) > self.MAX_METERS:
+                        continue
+
+                duplicate = self.entries[_id][3] if len(
+                    self.entries[_id]) > 3 else _id
+                break
+
+            if duplicate:
+                break
+
+        self._index(obj["id"], [hash, lat, lng] +
+                    ([duplicate] if duplicate else []))
+        self.added[obj["id"]] = self.entries[obj["id"]]
+
+        return duplicate
+
+    def store(self):
+
+        if len(self.added) == 0:
+            return
+
+        # the file may be shared with other agents running at the same time,
+        # so entries stored by them since loading are merged under a lock
+        with open(self.path, "a+") as f:
+            _lock(f)
+            f.seek(0)
+            try:
+                entries = json.loads(f.read())
+            except ValueError:
+                entries = {}
+
+            for _id, _entry in entries.items():
+                if _id not in self.entries:
+                    self._index(_id, _entry)
+
+            entries.update(self.added)
+            f.seek(0)
+            f.truncate()
+            f.write(json.dumps(entries, separators=(",", ":")))
+
+        self.added = {}
+
+
+# Full-text index (SQLite FTS5) over the descriptive texts of all objects.
+class SearchIndex:
+
+    def __init__(self, path, readonly=False):
+
+        import sqlite3
+
+        self.readonly = readonly
+        self.db = sqlite3.connect(path)
+        self.db.execute(
+            "CREATE VIRTUAL TABLE IF NOT EXISTS objects USING fts5(id UNINDEXED, title, descr, additions, area)")
+
+    @staticmethod
+    def texts(obj):
+
+        def _text(value):
+
+            if type(value) is str:
+                return re.sub("<[^>]+>", " ", value)
+            elif type(value) is list:
+                return "\n".join([_text(" ".join([_e["key"], _e["text"]]) if type(_e) is dict else _e) for _e in value])
+            else:
+                return ""
+
+        details = obj["details"] or {}
+
+        return [
+            "\n".join([obj["title"], obj["short_descr"]]),
+            _text(details.get("descr")),
+            _text(details.get("additions", details.get("features"))),
+            _text(details.get("area"))
+        ]
+
+    def add(self, objects):
+
+        if self.readonly:
+            return
+
+        with self.db:
+            for o in objects:
+                self.db.execute("DELETE FROM objects WHERE id = ?", (o["id"],))
+                self.db.execute(
+                    "INSERT INTO objects VALUES (?, ?, ?, ?, ?)", [o["id"]] + SearchIndex.texts(o))
+
+    def search(self, query, limit=50):
+
+        import sqlite3
+
+        try:
+            return [_row[0] for _row in self.db.execute(
+                "SELECT id FROM objects WHERE objects MATCH ? ORDER BY bm25(objects) LIMIT ?", (query, limit))]
+        except sqlite3.OperationalError as ex:
+            raise ValueError("Invalid search query \"%s\" (%s), use quotes for terms like \"2-Zimmer\"" % (query, ex))
+
+    def __len__(self):
+
+        return self.db.execute("SELECT count(*) FROM objects").fetchone()[0]
+
+
+# Records all HTTP exchanges into a directory or serves them back from it.
+# Each exchange is stored gzip compressed as a json header line followed by
+# the body, named by the hash of method, url and form fields.
+class HttpArchive:
+
+    def __init__(self, path, http=None):
+
+        self.path = path
+        self.http = http
+        self.counter = {}
+
+        if isinstance(self.http, Scheduler):
+            self.http.client = self
+
+        os.makedirs(self.path, exist_ok=True)
+
+    def request(self, method, url, headers=None, fields=None, **kwargs):
+
+        key = hashlib.sha1(json.dumps(
+            [method, url, sorted((fields or {}).items())]).encode("utf-8")).hexdigest()
+        self.counter[key] = self.counter.get(key, -1) + 1
+        filename = os.path.join(self.path, "%s-%i.gz" % (key, self.counter[key]))
+
+        if self.http is None:
+            import urllib3
+
+            with gzip.open(filename, "rb") as f:
+                header = json.loads(f.readline())
+                return urllib3.HTTPResponse(body=io.BytesIO(f.read()), status=header["status"], headers=header["headers"],
+                                            preload_content=kwargs.get("preload_content", True))
+
+        response = self.http.request(
+            method, url, headers=headers, fields=fields, **kwargs)
+        data = response.data if kwargs.get(
+            "preload_content", True) else response.read()
+        headers = {_k: _v for _k, _v in response.headers.items() if _k.lower() not in [
+            "content-encoding", "content-length", "transfer-encoding"]}
+
+        with gzip.open(filename, "wb") as f:
+            f.write(json.dumps({"method": method, "url": url, "status": response.status,
+                                "headers": headers}).encode("utf-8") + b"\n")
+            f.write(data)
+
+        if kwargs.get("preload_content", True):
+            return response
+
+        import urllib3
+
+        return urllib3.HTTPResponse(body=io.BytesIO(data), status=response.status, headers=headers, preload_content=False)
+
+
+# Central scheduler for all requests. Every host gets a token bucket
+# (rate per second and burst), a cap on concurrent requests and a block
+# period after 429/503 responses. A crawl-delay in robots.txt lowers the rate.
+class Scheduler:
+
+    def __init__(self, http, rate=2.0, burst=5, concurrency=4, retries=3, robots=True, max_retry_after=300):
+
+        self.http = http
+        self.rate = rate
+        self.burst = burst
+        self.concurrency = concurrency
+        self.retries = retries
+        self.robots = robots
+        self.max_retry_after = max_retry_after
+
+        self.lock = threading.Lock()
+        self.hosts = {}
+
+        # own requests (robots.txt) pass the outermost client, e.g. an
+        # HttpArchive recording this scheduler
+        self.client = self
+
+    def _host(self, url):
+
+        _url = urllib.parse.urlsplit(url)
+        host = "%s://%s" % (_url.scheme, _url.netloc)
+
+        with self.lock:
+            state = self.hosts.get(host)
+            fetch_robots = state is None and self.robots
+            if state is None:
+                state = self.hosts[host] = {
+                    "rate": self.rate,
+                    "tokens": self.burst,
+                    "updated": time.monotonic(),
+                    "blocked_until": 0,
+                    "semaphore": threading.Semaphore(self.concurrency),
+                    "ready": threading.Event(),
+                    "robots_thread": threading.get_ident()
+                }
+
+        if fetch_robots:
+            # robots.txt is requested outside the lock like any other request
+            _delay = self._crawl_delay(host)
+            if _delay:
+                with self.lock:
+                    state["rate"] = min(self.rate, 1 / _delay)
+            state["ready"].set()
+
+        elif self.robots and state["robots_thread"] != threading.get_ident():
+            # other requests to the host wait until the crawl-delay is known
+            state["ready"].wait()
+
+        return state
+
+    def _crawl_delay(self, host):
+
+        import urllib.robotparser
+
+        try:
+            response = self.client.request("GET", host + "/robots.txt")
+            if response.status != 200:
+                return None
+
+            robots = urllib.robotparser.RobotFileParser()
+            robots.parse(response.data.decode(
+                "utf-8", errors="replace").splitlines())
+            robots.modified()
+            return robots.crawl_delay("*")
+        except Exception:
+            return None
+
+    def _acquire(self, state):
+
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                state["tokens"] = min(self.burst, state["tokens"] +
+                                      (now - state["updated"]) * state["rate"])
+                state["updated"] = now
+
+                wait = state["blocked_until"] - now
+                if wait <= 0 and state["tokens"] >= 1:
+                    state["tokens"] -= 1
+                    return
+                elif wait <= 0:
+                    wait = (1 - state["tokens"]) / state["rate"]
+
+            time.sleep(wait)
+
+    def _retry_after(self, response):
+
+        value = response.headers.get("retry-after")
+        if not value:
+            return None
+
+        try:
+            delay = float(value)
+        except ValueError:
+            import email.utils
+
+            try:
+                delay = (email.utils.parsedate_to_datetime(value) -
+                         datetime.now(timezone.utc)).total_seconds()
+            except (TypeError, ValueError):
+                return None
+
+        return min(max(delay, 0), self.max_retry_after)
+
+    def request(self, method, url, **kwargs):
+
+        state = self._host(url)
+
+        for attempt in range(self.retries + 1):
+
+            self._acquire(state)
+            with state["semaphore"]:
+                response = self.http.request(method, url, **kwargs)
+
+            if response.status not in [429, 503] or attempt == self.retries:
+                return response
+
+            delay = self._retry_after(response)
+            response.release_conn()
+
+            with self.lock:
+                state["blocked_until"] = max(state["blocked_until"], time.monotonic() +
+                                             (delay if delay is not None else 2 ** attempt))
+
+
+# Canonical typed fields of an agent class. The class provides FIELDS, its
+# property keys to field names, and match_number for numeric texts.
+class Fields:
+
+    @classmethod
+    def canonical_key(cls, key):
+
+        return " ".join(key.replace("\u00ad", "").split())
+
+    @classmethod
+    def teaser_fields(cls, o):
+
+        def _number(s):
+            return float(s.replace(" 1/2", ",5").replace(".", "").replace(",", "."))
+
+        text = " ".join([o.get("title") or "", o.get("short_descr") or ""])
+        fields = {}
+
+        for _field, _pattern in [("rooms", r"(\d+(?:,\d+| 1/2)?)\s*-?\s*Zimmer"),
+                                 ("area_m2", r"(\d+(?:,\d+)?)\s*(?:m²|m2|qm)"),
+                                 ("rent_cold", r"(?:Kalt|Netto)[^\d]{0,30}(\d[\d\.]*(?:,\d+)?)"),
+                                 ("rent_total", r"(?:Gesamt|Warm)[^\d]{0,30}(\d[\d\.]*(?:,\d+)?)")]:
+            _match = re.search(_pattern, text, flags=re.IGNORECASE)
+            if _match:
+                fields[_field] = _number(_match.group(1))
+
+        return fields
+
+    @classmethod
+    def filter_bounds(cls, filter):
+
+        bounds = {}
+        details = (filter or {}).get("details", {})
+
+        for p in details.get("properties", []):
+            _key = cls.canonical_key(p.get("key", ""))
+            if _key in cls.FIELDS and type(p.get("value")) is list and len(p["value"]) == 2:
+                bounds[cls.FIELDS[_key]] = p["value"]
+
+        for _field, _value in details.get("fields", {}).items():
+            if type(_value) is list and len(_value) == 2:
+                bounds[_field] = _value
+
+        return bounds
+
+    def match_likelihood(self, o, bounds):
+
+        fields = self.teaser_fields(o)
+        score = 0
+
+        for _field, (_lo, _hi) in bounds.items():
+            if _field in fields:
+                score += 1 if _lo <= fields[_field] <= _hi else -1
+
+        return score
+
+    @classmethod
+    def normalise_properties(cls, properties):
+
+        fields = {_f: None for _f in cls.FIELDS.values()}
+
+        for p in properties:
+            key = cls.canonical_key(p["key"])
+            if key in cls.FIELDS and type(p["value"]) in [int, float]:
+                fields[cls.FIELDS[key]] = p["value"]
+            elif key in cls.FIELDS and type(p["value"]) is str and cls.match_number.match(p["value"]):
+                # e.g. Baujahr or Warmmiete, the property itself keeps its text value
+                fields[cls.FIELDS[key]] = float(cls.match_number.match(
+                    p["value"]).group(1).replace(".", "").replace(",", "."))
+
+        return fields